@@ -2,6 +2,7 @@
 """Script to backup LDAP databases in LDIF format using Git"""
 
 from __future__ import print_function
+import os
 import sys
 import subprocess
 import re
@@ -10,7 +11,65 @@ import pathlib
 import collections
 import configparser
 import time
+import base64
+import binascii
+import hashlib
+import ctypes
+import fcntl
+import json
+import concurrent.futures
+import shutil
+import tempfile
+import zlib
 import git
+from git.objects.util import altz_to_utctz_str
+
+# Size of the chunks read from the input in LDIFv1 mode
+LDIFV1_CHUNK_SIZE = 4 * 1024 * 1024
+# Comment line including its continuation lines (and preceding newline)
+RGX_LDIFV1_COMMENT = re.compile(r'\n#.*(?:\n .*)*')
+# Line separator between two attributes (not followed by a continuation)
+RGX_LDIFV1_ATTR_SEP = re.compile(r'\n(?! )')
+# Characters not allowed in filename values (path separators and control)
+RGX_UNSAFE_FNAME = re.compile(r'[/\\\x00-\x1f\x7f]')
+# Size of the chunks read from `git ls-tree`
+LS_TREE_CHUNK_SIZE = 1024 * 1024
+# Number of files written to temporary names before syncing in durable mode
+DURABLE_BATCH_SIZE = 8192
+# Suffix of temporary files in durable mode
+DURABLE_TMP_SUFFIX = '.tmp'
+# Size of the entries buffered in memory in bucket mode before spilling
+BUCKET_BUFFER_SIZE = 32 * 1024 * 1024
+
+# Attribute option marking a reference to a blob file with a base64 value
+BLOB_OPTION = 'x-ldif-git-backup-blob'
+# Base64 attribute (`attr:: value`) including continuation lines
+RGX_BASE64_ATTR = re.compile(
+    r'^([^:\n ][^:\n]*)::([^\n]*(?:\n [^\n]*)*)', re.M)
+# Separator between the RDNs of a DN (unescaped comma)
+RGX_DN_SEP = re.compile(r'(?<!\\),')
+# Reference to a blob file (`attr;x-ldif-git-backup-blob: sha256`)
+RGX_BLOB_REF = re.compile(
+    r'^([^:\n ][^:\n]*);' + BLOB_OPTION + r': ([0-9a-f]{64})$', re.M)
+
+# Files in the backup directory used to lock and coalesce runs
+LOCK_FILE = '.ldif-git-backup.lock'
+PENDING_FILE = '.ldif-git-backup.pending'
+# Input modes of the run holding the lock (written to the lock file)
+LOCK_HOLDER_SERVING = 'serving'
+LOCK_HOLDER_STDIN = 'stdin'
+# Notes ref used to store the change report of a commit
+CHANGE_REPORT_REF = 'ldif-git-backup'
+# Id of the empty tree, used to diff against an empty repository
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+# Files in the git directory used by the replication to mirrors
+REPLICATION_STATUS = 'ldif-git-backup-replication.json'
+REPLICATION_LOCK = 'ldif-git-backup-replication.lock'
+
+try:
+    LIBC_SYNCFS = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError):
+    LIBC_SYNCFS = None
 
 
 def eprint(*args, **kwargs):
@@ -39,11 +98,19 @@ class Context(object):
         'no_commit': False,
         'no_dirty_check': False,
         'single_ldif': False,
+        'buckets': '0',
         'ldif_name': 'db',
         'ldif_wrap': False,
         'ldif_v1': False,
         'ldif_mem': False,
         'no_out': False,
+        'durable': False,
+        'blob_size': '0',
+        'retention': '',
+        'retention_bundle': '',
+        'mirrors': '',
+        'mirror_jobs': '2',
+        'change_report': '',
     }
 
     def __init__(self):
@@ -55,6 +122,18 @@ class Context(object):
             'repo': None,
             'new_commit_files': None,
             'last_commit_files': None,
+            'retention': None,
+            'squashed': False,
+            'rewritten': {},
+            'replaced': set(),
+            'writer': None,
+            'blob_size': 0,
+            'buckets': 0,
+            'mirrors': [],
+            'mirror_jobs': 2,
+            'lock': None,
+            'change_report': None,
+            'commit': None,
         }
         self.start_time_measurement()
         self.initialize_param()
@@ -62,6 +141,10 @@ class Context(object):
         self.initialize_input_method()
         self.initialize_ldif_attr()
         self.initialize_regex()
+        self.initialize_retention()
+        self.initialize_blob_size()
+        self.initialize_buckets()
+        self.initialize_mirrors()
         self.clean_ldif_cmd()
 
     def parse_args(self):
@@ -85,7 +168,10 @@ class Context(object):
             will correctly handle LDIFv1 input (for example if it contains
             comments or mutliple blank lines between entries). Any comments
             will be stripped off the output LDIF, line wrapping is preserved.
-            Using this mode is a bit slower than the default mode.'''
+            Base64 (`::`) values of LDIF_ATTR are decoded for use as filename,
+            decoded values containing path separators or control characters
+            are hex encoded. URL (`:<`) values are replaced by the sha256 of
+            the URL.'''
         )
         group_input = parser.add_mutually_exclusive_group(required=False)
         group_input.add_argument(
@@ -136,6 +222,15 @@ class Context(object):
             dest='single_ldif', action='store_const', const=True,
             help='Use single LDIF mode, do not split entries to files'
         )
+        parser.add_argument(
+            '-b', '--buckets',
+            dest='buckets', type=str,
+            help='''Use bucket mode, write the entries to BUCKETS files
+            (`bucket-<n>.ldif`) selected by a stable hash of the value of
+            LDIF_ATTR. The entries in a bucket are sorted by this value, only
+            changed buckets are rewritten. Can not be combined with `-s`.
+            (default: `0`, disabled)'''
+        )
         parser.add_argument(
             '-n', '--ldif-name',
             dest='ldif_name', type=str,
@@ -186,6 +281,22 @@ class Context(object):
             dest='no_dirty_check', action='store_const', const=True,
             help='Do not check if repo is dirty before commit. Always commit.'
         )
+        parser.add_argument(
+            '--durable',
+            dest='durable', action='store_const', const=True,
+            help='''Write new or changed LDIF files durably: files are written
+            to temporary names and renamed in batches after syncing the file
+            system, which is synced again before commit'''
+        )
+        parser.add_argument(
+            '--blob-size',
+            dest='blob_size', type=str,
+            help='''Move base64 values (`attr:: value`) longer than BLOB_SIZE
+            characters to separate files named after the SHA-256 of the value
+            (`<sha256>.b64`), the value is replaced by the reference
+            `attr;x-ldif-git-backup-blob: <sha256>`. Identical values are
+            stored once. (default: `0`, disabled)'''
+        )
         group_ldif = parser.add_mutually_exclusive_group(required=False)
         group_ldif.add_argument(
             '-w', '--ldif-wrap',
@@ -198,14 +309,63 @@ class Context(object):
             '-1', '--ldif-v1',
             dest='ldif_v1', action='store_const', const=True,
             help='''Parse input in LDIFv1 format (Version: 1) as per RFC 2849.
-            Comments are ignored, line wrapping is preserved. Using this mode
-            is a bit slower than the default mode.'''
+            Comments are ignored, line wrapping is preserved. Base64 and URL
+            values are supported for the filename attribute.'''
         )
         parser.add_argument(
             '--mem',
             dest='ldif_mem', action='store_const', const=True,
             help='Read input LDIF to memory first (experimental option)'
         )
+        parser.add_argument(
+            '--retention',
+            dest='retention', type=str,
+            help='''Squash the history according to the retention policy
+            ALL_DAYS:DAILY_DAYS. All commits of the last ALL_DAYS days are
+            kept, the last commit of each day is kept for DAILY_DAYS days and
+            the last commit of each month is kept afterwards. The history is
+            rewritten without checking out any files (example: `7:90`)'''
+        )
+        parser.add_argument(
+            '--retention-bundle',
+            dest='retention_bundle', type=str,
+            help='''Archive the range of squashed commits as git bundle in
+            directory RETENTION_BUNDLE'''
+        )
+        parser.add_argument(
+            '--change-report',
+            dest='change_report', type=str,
+            help='''Create a report of the added, deleted and modified entries
+            (JSON lines with DN, entryUUID, change type and changed attribute
+            names). CHANGE_REPORT `note` attaches the report to the commit as
+            git note (`git log --notes=ldif-git-backup`), otherwise it is the
+            path of the file the reports of the commits of a run are written
+            to (with the commit id in each line)'''
+        )
+        parser.add_argument(
+            '--mirrors',
+            dest='mirrors', type=str,
+            help='''Push each new commit to the git repositories MIRRORS
+            (separated by commas or whitespace) in a background process.
+            Missing local mirrors are created as bare repositories. Failed
+            pushes are reported and retried on the next run'''
+        )
+        parser.add_argument(
+            '--mirror-jobs',
+            dest='mirror_jobs', type=str,
+            help='Number of concurrent pushes to mirrors (default: `2`)'
+        )
+        parser.add_argument(
+            '--replicate',
+            dest='replicate', action='store_const', const=True,
+            help=argparse.SUPPRESS
+        )
+        parser.add_argument(
+            '--export',
+            dest='export', action='store_const', const=True,
+            help='''Write the LDIF of the backup directory to stdout (with
+            all blob references re-inlined) and exit'''
+        )
         parser.add_argument(
             '-v', '--verbose',
             dest='verbose', action='store_const', const=True,
@@ -338,6 +498,42 @@ class Context(object):
             regex = r'(' + self.param['excl_attrs'] + r'):'
             self.var['rgx_excl'] = re.compile(regex)
 
+    def initialize_retention(self):
+        """Parse the retention policy"""
+        retention = self.param['retention']
+        if retention:
+            match = re.fullmatch(r'(\d+):(\d+)', retention.strip())
+            if not match or int(match.group(1)) > int(match.group(2)):
+                sys.exit('Error: invalid retention policy: %s' % retention)
+            self.var['retention'] = (int(match.group(1)),
+                                     int(match.group(2)))
+
+    def initialize_blob_size(self):
+        """Parse the blob size threshold"""
+        blob_size = str(self.param['blob_size']).strip()
+        if not blob_size.isdigit():
+            sys.exit('Error: invalid blob size: %s' % blob_size)
+        self.var['blob_size'] = int(blob_size)
+
+    def initialize_buckets(self):
+        """Parse the number of buckets"""
+        buckets = str(self.param['buckets']).strip()
+        if not buckets.isdigit():
+            sys.exit('Error: invalid number of buckets: %s' % buckets)
+        if int(buckets) and self.param['single_ldif']:
+            sys.exit('Error: bucket mode can not be combined with single-ldif')
+        self.var['buckets'] = int(buckets)
+
+    def initialize_mirrors(self):
+        """Parse the list of mirrors and the number of concurrent pushes"""
+        mirrors = self.param['mirrors'].strip()
+        if mirrors:
+            self.var['mirrors'] = re.split(r'[\s,]+', mirrors)
+        mirror_jobs = str(self.param['mirror_jobs']).strip()
+        if not mirror_jobs.isdigit() or int(mirror_jobs) < 1:
+            sys.exit('Error: invalid number of mirror jobs: %s' % mirror_jobs)
+        self.var['mirror_jobs'] = int(mirror_jobs)
+
     def clean_ldif_cmd(self):
         """Replace all whitespace characters with single whitespace"""
         ldif_cmd = self.param['ldif_cmd']
@@ -347,6 +543,75 @@ class Context(object):
             self.param['ldif_cmd'] = clean_ldif_cmd.split(' ')
 
 
+def sync_filesystem(path):
+    """Flush all data of the file system containing path (syncfs)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if LIBC_SYNCFS is None or LIBC_SYNCFS(fd) != 0:
+            os.sync()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DurableWriter(object):
+    """Class to write LDIF files durably in batches:
+    - new or changed files are written to temporary names
+    - the file system is synced once per batch, then the files are renamed
+    - the renames are synced on close
+    """
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        self.pending = []
+        self.renamed = 0
+
+    def remove_stale_files(self):
+        """Remove the temporary files left behind by an interrupted run"""
+        suffixes = tuple(''.join([ext, DURABLE_TMP_SUFFIX])
+                         for ext in ('.ldif', '.b64'))
+        removed = 0
+        with os.scandir(self.path_prefix) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffixes) and entry.is_file():
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    def add(self, tmp_path, fpath):
+        """Register a written temporary file to be renamed to fpath"""
+        self.pending.append((tmp_path, fpath))
+
+    def write(self, fpath, data):
+        """Write data to fpath unless the file content is unchanged"""
+        try:
+            with open(fpath, 'r') as fin:
+                if fin.read() == data:
+                    return
+        except FileNotFoundError:
+            pass
+        tmp_path = ''.join([fpath, DURABLE_TMP_SUFFIX])
+        with open(tmp_path, 'w') as fout:
+            fout.write(data)
+        self.add(tmp_path, fpath)
+        if len(self.pending) >= DURABLE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Sync the pending temporary files and rename them"""
+        if self.pending:
+            sync_filesystem(self.path_prefix)
+            for tmp_path, fpath in self.pending:
+                os.replace(tmp_path, fpath)
+            self.renamed += len(self.pending)
+            self.pending = []
+
+    def close(self):
+        """Flush the pending files and sync the renames"""
+        self.flush()
+        if self.renamed:
+            sync_filesystem(self.path_prefix)
+
+
 def create_backup_directory(context):
     """Create backup directory"""
     dpath = pathlib.PosixPath(context.param['backup_dir'])
@@ -354,23 +619,114 @@ def create_backup_directory(context):
     context.var['path_prefix'] = ''.join([dpath.as_posix(), '/'])
 
 
+def set_lock_holder(lock, holder):
+    """Write the input mode of the run holding the lock to the lock file"""
+    lock.seek(0)
+    lock.truncate()
+    lock.write(holder)
+    lock.flush()
+
+
+def lock_backup_directory(context):
+    """Lock the backup directory, if another run that can serve pending
+    requests is in progress register a pending request for it and exit
+    (otherwise wait for the lock)"""
+    var = context.var
+    # Do not truncate the lock file, it contains the input mode of the holder
+    lock = open(''.join([var['path_prefix'], LOCK_FILE]), 'a+')
+    pending = ''.join([var['path_prefix'], PENDING_FILE])
+    if context.param['ldif_cmd'] or context.param['ldif_file']:
+        holder = LOCK_HOLDER_SERVING
+        # The active run checks for pending requests after unlocking
+        open(pending, 'w').close()
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.seek(0)
+            if lock.read() == LOCK_HOLDER_SERVING:
+                context.verbose('backup in progress, '
+                                'registered pending request')
+                sys.exit()
+            # The holder reads stdin (or is unlocking) and will not serve
+            # the request
+            context.verbose('waiting for backup in progress')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            os.remove(pending)
+        except FileNotFoundError:
+            pass
+    else:
+        holder = LOCK_HOLDER_STDIN
+        # Input from stdin can not be read again by a pending run
+        context.verbose('locking backup directory')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    set_lock_holder(lock, holder)
+    var['lock'] = lock
+
+
+def unlock_backup_directory(context):
+    """Unlock the backup directory, return True if a pending request was
+    registered and the lock could be acquired again to serve it"""
+    var = context.var
+    lock = var['lock']
+    # New runs must not rely on this run while it is unlocking
+    set_lock_holder(lock, '')
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    if not (context.param['ldif_cmd'] or context.param['ldif_file']):
+        return False
+    pending = ''.join([var['path_prefix'], PENDING_FILE])
+    if not os.path.exists(pending):
+        return False
+    # Wait for the lock, a serving run acquiring it first removes the request
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    if not os.path.exists(pending):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+    set_lock_holder(lock, LOCK_HOLDER_SERVING)
+    try:
+        os.remove(pending)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def exclude_lock_files(repo):
+    """Add the lock and pending files to the excludes of the repository"""
+    fpath = os.path.join(repo.git_dir, 'info', 'exclude')
+    try:
+        with open(fpath, 'r') as fin:
+            content = fin.read()
+    except FileNotFoundError:
+        content = ''
+    lines = content.splitlines()
+    missing = [''.join(['/', f, '\n']) for f in (LOCK_FILE, PENDING_FILE)
+               if ''.join(['/', f]) not in lines]
+    if missing:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'a') as fout:
+            if content and not content.endswith('\n'):
+                fout.write('\n')
+            fout.write(''.join(missing))
+
+
 def initialize_git_repository(context):
     """Initialize git repo, get file list from last commit"""
     param = context.param
     var = context.var
 
     if not (param['no_rm'] and param['no_add'] and param['no_gc'] and
-            param['no_commit']):
+            param['no_commit'] and not param['retention'] and
+            not param['mirrors'] and not param['change_report']):
         context.verbose('initializing git repo:', var['path_prefix'])
         repo = git.Repo.init(var['path_prefix'])
         context.var['repo'] = repo
+        exclude_lock_files(repo)
 
     if not param['no_rm']:
         if len(repo.heads) == 0:
-            var['last_commit_files'] = []
+            var['last_commit_files'] = set()
         else:
-            files_in_repo_root = repo.head.commit.tree.blobs
-            var['last_commit_files'] = [f.name for f in files_in_repo_root]
+            var['last_commit_files'] = get_last_commit_files(repo)
         context.verbose('files in repository:',
                         str(len(var['last_commit_files'])))
 
@@ -391,22 +747,58 @@ class LdifDeque(object):
         except IndexError:
             return None
 
+    def read(self, size):
+        """Return lines with a total length of at least size"""
+        lines = []
+        length = 0
+        while length < size and self.lines:
+            line = self.lines.popleft()
+            lines.append(line)
+            length += len(line)
+        return b''.join(lines)
+
     def close(self):
         """Imitate close of fd"""
         pass
 
 
+def get_last_commit_files(repo):
+    """Return a set of the files in the root tree of HEAD"""
+    files = set()
+    proc = repo.git.ls_tree('-z', 'HEAD', as_process=True)
+    rest = b''
+    while True:
+        chunk = proc.stdout.read(LS_TREE_CHUNK_SIZE)
+        if not chunk:
+            break
+        records = b''.join([rest, chunk]).split(b'\0')
+        rest = records.pop()
+        for record in records:
+            # Record format: `<mode> SP <type> SP <object> TAB <file>`
+            meta, fname = record.split(b'\t', 1)
+            if b' blob ' in meta:
+                files.add(fname.decode('utf-8'))
+    proc.wait()
+    return files
+
+
 def get_input_method(context):
     """Determine LDIF input method and return file descriptor"""
     param = context.param
 
     if param['ldif_file']:
-        fin = open(param['ldif_file'], 'r')
+        if param['ldif_v1']:
+            fin = open(param['ldif_file'], 'rb')
+        else:
+            fin = open(param['ldif_file'], 'r')
         context.verbose('reading ldif from file')
     elif param['ldif_cmd']:
         proc = subprocess.Popen(param['ldif_cmd'], stdout=subprocess.PIPE)
         fin = proc.stdout
         context.verbose('reading ldif from subprocess')
+    elif param['ldif_v1']:
+        fin = sys.stdin.buffer
+        context.verbose('reading ldif from stdin')
     else:
         fin = sys.stdin
         context.verbose('reading ldif from stdin')
@@ -426,20 +818,135 @@ def get_input_method(context):
         return fin
 
 
+class BucketWriter(object):
+    """Class to write entries to a fixed number of bucket files:
+    - entries are buffered in memory per bucket while streaming
+    - if the buffers exceed BUCKET_BUFFER_SIZE they are appended to spill
+      files (opened only while appending) in a temporary directory
+    - on close the entries of each bucket are sorted by their key
+    - only buckets with changed content are rewritten
+    """
+    def __init__(self, context, files):
+        self.path_prefix = context.var['path_prefix']
+        self.buckets = context.var['buckets']
+        self.writer = context.var['writer']
+        self.no_out = context.param['no_out']
+        self.files = files
+        self.width = len(str(self.buckets - 1))
+        self.indexes = set()
+        self.buffers = {}
+        self.buffered = 0
+        self.spilled = set()
+        self.spill_dir = None
+
+    def bucket_fname(self, index):
+        """Return the filename of a bucket"""
+        return ''.join(['bucket-', str(index).zfill(self.width), '.ldif'])
+
+    def spill_path(self, index):
+        """Return the path of the spill file of a bucket"""
+        return os.path.join(self.spill_dir, str(index))
+
+    def add(self, key, text):
+        """Add the LDIF text of an entry with sort key to its bucket"""
+        key = (key or '').replace('\n', ' ')
+        index = zlib.crc32(key.encode('utf-8')) % self.buckets
+        self.indexes.add(index)
+        if self.no_out:
+            return
+        record = ''.join(['# ', key, '\n', text])
+        self.buffers.setdefault(index, []).append(record)
+        self.buffered += len(record)
+        if self.buffered >= BUCKET_BUFFER_SIZE:
+            self.spill()
+
+    def spill(self):
+        """Append the buffered entries to the spill files of their buckets"""
+        if self.spill_dir is None:
+            # Keep the spill files out of the work tree
+            git_dir = os.path.join(self.path_prefix, '.git')
+            self.spill_dir = tempfile.mkdtemp(
+                prefix='ldif-git-backup-buckets-',
+                dir=git_dir if os.path.isdir(git_dir) else None)
+        for index, records in self.buffers.items():
+            with open(self.spill_path(index), 'a') as fout:
+                fout.write(''.join(records))
+            self.spilled.add(index)
+        self.buffers = {}
+        self.buffered = 0
+
+    def write_bucket(self, index):
+        """Sort the entries of a bucket and write it if changed"""
+        records = self.buffers.pop(index, [])
+        if index in self.spilled:
+            with open(self.spill_path(index), 'r') as fin:
+                records.insert(0, fin.read())
+        entries = []
+        for record in ''.join(records).split('\n\n'):
+            if record:
+                key, _, entry = record.partition('\n')
+                entries.append((key, ''.join([entry, '\n\n'])))
+        entries.sort(key=lambda e: e[0])
+        text = ''.join(e[1] for e in entries)
+        fpath = ''.join([self.path_prefix, self.bucket_fname(index)])
+        if self.writer:
+            self.writer.write(fpath, text)
+            return
+        try:
+            with open(fpath, 'r') as fin:
+                if fin.read() == text:
+                    return
+        except FileNotFoundError:
+            pass
+        with open(fpath, 'w') as fout:
+            fout.write(text)
+
+    def close(self):
+        """Write all buckets and register their filenames"""
+        try:
+            for index in sorted(self.indexes):
+                self.files[self.bucket_fname(index)] = 0
+                if not self.no_out:
+                    self.write_bucket(index)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Drop the buffered entries and remove the spill files"""
+        self.buffers = {}
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
 def get_output_method(context):
     """"Determine LDIF output method and return file descriptor"""
     param = context.param
     var = context.var
     files = {}
+    if param['durable'] and not param['no_out']:
+        var['writer'] = DurableWriter(var['path_prefix'])
+        removed = var['writer'].remove_stale_files()
+        if removed:
+            context.verbose('removed stale temporary files:', str(removed))
 
     if param['single_ldif']:
         # Open LDIF file for writing
         fname = ''.join([param['ldif_name'], '.ldif'])
         fpath = ''.join([var['path_prefix'], fname])
         files[fname] = 0
+        if var['writer']:
+            tmp_path = ''.join([fpath, DURABLE_TMP_SUFFIX])
+            var['writer'].add(tmp_path, fpath)
+            fpath = tmp_path
         fout = open(fpath, 'w')
         context.verbose('single-ldif mode, writing to:', fname)
         return fout, files
+    elif var['buckets']:
+        fout = BucketWriter(context, files)
+        context.verbose('bucket mode, writing to:', str(var['buckets']),
+                        'buckets')
+        return fout, files
     else:
         context.verbose('multi-ldif mode, writing to:',
                         ''.join(['<', param['ldif_attr'], '>', '.ldif']))
@@ -459,11 +966,14 @@ class LoopVariables(object):
         self.ldif_cmd = False
         self.excl_attrs = False
         self.single_ldif = False
+        self.buckets = False
         self.ldif_wrap = False
         self.path_prefix = None
         self.fname_attr_search = None
         self.rgx_excl = None
         self.no_out = False
+        self.writer = None
+        self.blob_size = 0
         self.init_vars(context)
 
     def init_vars(self, context):
@@ -476,6 +986,8 @@ class LoopVariables(object):
             self.excl_attrs = True
         if context.param['single_ldif']:
             self.single_ldif = True
+        if context.var['buckets']:
+            self.buckets = True
         if context.param['ldif_wrap']:
             self.ldif_wrap = True
         if context.param['no_out']:
@@ -483,6 +995,8 @@ class LoopVariables(object):
         self.init_path_prefix(context.var)
         self.init_fname_attr_search(context.param)
         self.init_rgx_excl(context.var)
+        self.writer = context.var['writer']
+        self.blob_size = context.var['blob_size']
 
     def init_path_prefix(self, var):
         """Initialize path_prefix"""
@@ -497,14 +1011,83 @@ class LoopVariables(object):
         self.rgx_excl = var['rgx_excl']
 
 
+def write_blob(var, value, files):
+    """Write a base64 value to a content-addressed file (unless no_out is
+    set) and register its filename, return its hash"""
+    sha = hashlib.sha256(value.encode('utf-8')).hexdigest()
+    fname = ''.join([sha, '.b64'])
+    if fname not in files:
+        files[fname] = 0
+        fpath = ''.join([var.path_prefix, fname])
+        # Blob files are content-addressed, an existing file is up to date
+        if not var.no_out and not os.path.exists(fpath):
+            if var.writer:
+                var.writer.write(fpath, value)
+            else:
+                with open(fpath, 'w') as fout:
+                    fout.write(value)
+    return sha
+
+
+def externalize_blobs(var, entry, files):
+    """Replace large base64 values in entry with references to blob files"""
+    text = ''.join(entry)
+    if '::' not in text:
+        return entry
+
+    # The DN and the filename attribute are never externalized
+    kept = ('dn', var.fname_attr_search[:-1].lower())
+
+    def replace(match):
+        """Replace a single base64 value if it is large"""
+        if len(match.group(2)) <= var.blob_size:
+            return match.group(0)
+        if match.group(1).split(';', 1)[0].lower() in kept:
+            return match.group(0)
+        sha = write_blob(var, match.group(2), files)
+        return ''.join([match.group(1), ';', BLOB_OPTION, ': ', sha])
+
+    return [RGX_BASE64_ATTR.sub(replace, text)]
+
+
+def inline_blobs(path_prefix, text):
+    """Replace references to blob files in text with the base64 values"""
+    if BLOB_OPTION not in text:
+        return text
+
+    def replace(match):
+        """Replace a single reference with the value of the blob file"""
+        fpath = ''.join([path_prefix, match.group(2), '.b64'])
+        with open(fpath, 'r') as fin:
+            return ''.join([match.group(1), '::', fin.read()])
+
+    return RGX_BLOB_REF.sub(replace, text)
+
+
+def read_entry(path_prefix, fname):
+    """Return the LDIF of a file with blob references re-inlined"""
+    with open(''.join([path_prefix, fname]), 'r') as fin:
+        return inline_blobs(path_prefix, fin.read())
+
+
 def write_ldif(var, fout, entry, fname_attr_val, files):
     """Write the LDIF"""
     entry.append('\n')
     if var.single_ldif:
         # Add entry to single LDIF file
+        if var.blob_size:
+            entry = externalize_blobs(var, entry, files)
         if not var.no_out:
             for line in entry:
                 fout.write(line)
+    elif var.buckets:
+        # Add entry to its bucket
+        if not entry or entry[0] == '\n' or entry[0] == '':
+            eprint('Invalid entry:', entry)
+            return
+        if var.blob_size:
+            entry = externalize_blobs(var, entry, files)
+        fout.add(fname_attr_val, ''.join(entry))
     else:
         # Write entry to new LDIF file
         if fname_attr_val:
@@ -539,123 +1122,184 @@ def write_ldif(var, fout, entry, fname_attr_val, files):
                 fpath = ''.join([var.path_prefix, fname])
             eprint('Warning: empty filename detected:', fname)
             eprint('Entry:', entry)
-        if not var.no_out:
+        if var.blob_size:
+            entry = externalize_blobs(var, entry, files)
+        if var.writer:
+            var.writer.write(fpath, ''.join(entry))
+        elif not var.no_out:
             with open(fpath, 'w') as fout_new:
                 for line in entry:
                     fout_new.write(line)
 
 
-def loop_ldifv1(var, fin, fout, files):
-    """Stream from LDIFv1 input and write LDIF output"""
-    entry_end = False
-    ldif_end = False
-    write_entry = False
-    comment = False
-    fname = None
-    broken_attr = None
-    finding_broken_attr = False
-    fname_found = False
-    next_line_broken = False
-    next_line_sep = False
-    line = parse_ldif_version(var, fin)
-    next_line = None
-    entry = []
+def read_ldifv1_blocks(fin):
+    """Read LDIFv1 input in chunks and yield blocks of complete records"""
+    rest = b''
+    header = True
     while True:
-        next_line = fin.readline()
-        if not next_line:
-            ldif_end = True
-            next_line = ''
-        if var.ldif_cmd and not ldif_end:
-            next_line = next_line.decode('utf-8')
-        # check column 1
-        if next_line[:1] == ' ':
-            next_line_broken = True
-            next_line_sep = False
-        elif next_line[:1] == '\n' or next_line == '\r\n':
-            next_line_sep = True
-            next_line_broken = False
-        else:
-            next_line_broken = False
-            next_line_sep = False
-        if line[:1] == '#':
-            comment = True
-        # Filter comments
-        if comment:
-            if next_line_broken:
-                continue
-            elif next_line_sep:
-                comment = False
-                continue
-            else:
-                line = next_line
-                comment = False
-                continue
-        # Filter newlines between entries
-        if write_entry:
-            entry_end = True
-        if entry_end:
-            if next_line_sep:
-                continue
+        chunk = fin.read(LDIFV1_CHUNK_SIZE)
+        eof = not chunk
+        data = b''.join([rest, chunk])
+        # Normalize line separators (a trailing CR stays in rest)
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n')
+        # Skip everything before the first dn line
+        if header:
+            if data.startswith(b'dn:'):
+                pos = 0
             else:
-                write_entry = False
-                entry_end = False
-        elif next_line_sep:
-            write_entry = True
-        # Find broken attribute
-        if finding_broken_attr:
-            if next_line_broken:
-                line = ''.join([line, next_line])
-                continue
-            else:
-                finding_broken_attr = False
-                broken_attr = True
-                # Broken attribute found, next_line is new attribute
-        elif next_line_broken:
-            line = ''.join([line, next_line])
-            finding_broken_attr = True
-            continue
-        else:
-            broken_attr = False
-        # Find filename and filter attributes
-        if broken_attr:
-            attr = line.replace('\r\n ', '').replace('\n ', '')
-            if not var.single_ldif and not fname_found:
-                if attr.startswith(var.fname_attr_search):
-                    fname = attr.split(var.fname_attr_search, 1)[1].strip()
-                    fname_found = True
-                    # Found broken filename
-            if var.excl_attrs:
-                match_excl = var.rgx_excl.match(attr)
-                if match_excl:
-                    line = ''
-                    # Broken attribute filtered
-            broken_attr = False
+                pos = data.find(b'\ndn:') + 1
+                if not pos:
+                    if eof:
+                        sys.exit('Error: parsing LDIF input')
+                    rest = data
+                    continue
+            parse_ldif_version(data[:pos].decode('utf-8'))
+            data = data[pos:]
+            header = False
+        # Cut after the last complete record
+        if eof:
+            cut = len(data)
         else:
-            if not var.single_ldif and not fname_found:
-                if line.startswith(var.fname_attr_search):
-                    fname = line.split(var.fname_attr_search, 1)[1].strip()
-                    fname_found = True
-                    # Found filename attribute
-            if var.excl_attrs:
-                match_excl = var.rgx_excl.match(line)
-                if match_excl:
-                    line = ''
-                    # Attribute filtered
-        # Add line to entry
-        if line:
-            entry.append(line)
-        if not ldif_end:
-            line = next_line
-        else:
-            if entry:
-                write_ldif(var, fout, entry, fname, files)
+            cut = data.rfind(b'\n\n') + 1
+        if cut:
+            yield data[:cut].decode('utf-8')
+        rest = data[cut:]
+        if eof:
             break
-        if write_entry:
-            write_ldif(var, fout, entry, fname, files)
-            entry = []
-            line = ''
-            fname_found = False
+
+
+def find_ldifv1_value(record, search):
+    """Return the unfolded raw value of the attribute `search` (the attribute
+    name with a leading newline and trailing colon), including the `:` or `<`
+    marker of base64 and URL values"""
+    if record.startswith(search[1:]):
+        start = len(search) - 1
+    else:
+        start = record.find(search)
+        if start < 0:
+            return None
+        start += len(search)
+    end = record.find('\n', start)
+    if end < 0:
+        return record[start:]
+    value = record[start:end]
+    # Join continuation lines
+    if record.startswith(' ', end + 1):
+        parts = [value]
+        while end >= 0 and record.startswith(' ', end + 1):
+            nxt = record.find('\n', end + 1)
+            parts.append(record[end + 2:nxt if nxt >= 0 else None])
+            end = nxt
+        value = ''.join(parts)
+    return value
+
+
+def decode_ldifv1_value(value):
+    """Decode a raw value returned by find_ldifv1_value, URL values are
+    returned as URL"""
+    if value[:1] == ':':
+        # Base64 encoded value
+        try:
+            raw = base64.b64decode(value[1:].strip())
+        except binascii.Error:
+            eprint('Warning: invalid base64 value:', value[1:].strip())
+            return None
+        try:
+            return raw.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            return raw.hex()
+    elif value[:1] == '<':
+        return value[1:].strip()
+    return value.strip()
+
+
+def get_ldifv1_value(record, search):
+    """Return the unfolded and decoded value of the attribute `search`"""
+    value = find_ldifv1_value(record, search)
+    if value is None:
+        return None
+    return decode_ldifv1_value(value)
+
+
+def get_ldifv1_fname(value):
+    """Return a raw (folded) value for use as filename. URL values are
+    replaced by the sha256 of the URL, values containing path separators or
+    control characters are hex encoded"""
+    if '\n' in value:
+        value = value.replace('\n ', '')
+    if value[:1] == '<':
+        return hashlib.sha256(value[1:].strip().encode('utf-8')).hexdigest()
+    value = decode_ldifv1_value(value)
+    if value and RGX_UNSAFE_FNAME.search(value):
+        return value.encode('utf-8').hex()
+    return value
+
+
+def filter_ldifv1_record(record, rgx_excl):
+    """Remove all (folded) attributes matching rgx_excl from record"""
+    attrs = RGX_LDIFV1_ATTR_SEP.split(record)
+    kept = []
+    for attr in attrs:
+        if '\n ' in attr:
+            match_excl = rgx_excl.match(attr.replace('\n ', ''))
+        else:
+            match_excl = rgx_excl.match(attr)
+        if not match_excl:
+            kept.append(attr)
+    return '\n'.join(kept)
+
+
+def loop_ldifv1(var, fin, fout, files):
+    """Stream from LDIFv1 input and write LDIF output"""
+    # Filename attribute with the preceding newline (much faster to search
+    # for than `^` in multiline mode), group 1 is a plain unfolded value
+    # usable as filename as is, group 2 any other value including its
+    # continuation lines
+    rgx_fname = re.compile(''.join([
+        '\n', re.escape(var.fname_attr_search),
+        r'(?:(?![:<]) *((?:[^\n/\\\x00-\x1f\x7f]*[^\n/\\\x00-\x1f\x7f ])?)',
+        r'(?=\n(?! )|$)',
+        r'|([^\n]*(?:\n [^\n]*)*))']))
+    for block in read_ldifv1_blocks(fin):
+        # Remove comments including their continuation lines
+        if block.startswith('#'):
+            block = ''.join(['\n', block])
+        if '\n#' in block:
+            block = RGX_LDIFV1_COMMENT.sub('', block)
+        block = block.strip('\n')
+        # Find the filename values of all records in one pass, the matches
+        # are assigned to the records by the offset of their newline (the
+        # newline before the first line of a record is at its start offset
+        # in the block prefixed with a newline)
+        matches = iter(())
+        if not var.single_ldif:
+            matches = rgx_fname.finditer(''.join(['\n', block]))
+        match = next(matches, None)
+        end = -2
+        for record in block.split('\n\n'):
+            start = end + 2
+            end = start + len(record)
+            # Skip additional empty lines between records
+            if record.startswith('\n'):
+                record = record.lstrip('\n')
+            if not record:
+                continue
             fname = None
+            # Skip repeated filename attributes of previous records
+            while match and match.start() < start:
+                match = next(matches, None)
+            if match and match.start() < end:
+                fname = match.group(1)
+                if fname is None:
+                    fname = get_ldifv1_fname(match.group(2))
+                match = next(matches, None)
+            if var.excl_attrs:
+                record = filter_ldifv1_record(record, var.rgx_excl)
+            if record:
+                write_ldif(var, fout, [record, '\n'], fname, files)
+            else:
+                write_ldif(var, fout, [], fname, files)
 
     return files
 
@@ -765,39 +1409,80 @@ def loop(var, fin, fout, files):
     return files
 
 
-def parse_ldif_version(var, fin):
+def parse_ldif_version(header):
     """Parse the LDIF version header"""
-    while True:
-        line = fin.readline()
-        if not line:
-            sys.exit("Error: parsing LDIF input")
-        if var.ldif_cmd:
-            line = line.decode('utf-8')
+    for line in header.splitlines():
         if line.startswith('version:'):
             version = line.split(':', 1)[1].strip()
             if version != '1':
                 eprint("Warning: expecting LDIFv1 compatible input")
-        if line.startswith('dn:'):
-            return line
 
 
 def process_ldif(context):
     """Process LDIF with method depending on the parameters"""
-    # Local variables to speed up processing
-    loop_var = LoopVariables(context)
     fin = get_input_method(context)
     fout, files = get_output_method(context)
+    # Local variables to speed up processing
+    loop_var = LoopVariables(context)
 
-    if context.param['ldif_v1']:
-        files = loop_ldifv1(loop_var, fin, fout, files)
-    else:
-        if not context.param['ldif_wrap']:
-            files = loop(loop_var, fin, fout, files)
+    try:
+        if context.param['ldif_v1']:
+            files = loop_ldifv1(loop_var, fin, fout, files)
         else:
-            files = loop_unwrap(loop_var, fin, fout, files)
+            if not context.param['ldif_wrap']:
+                files = loop(loop_var, fin, fout, files)
+            else:
+                files = loop_unwrap(loop_var, fin, fout, files)
+    except BaseException:
+        # Do not write the buckets of an incomplete input
+        if context.var['buckets']:
+            fout.discard()
+        raise
 
     context.var['new_commit_files'] = files
     close_file_descriptors(fin, fout)
+    if context.var['writer']:
+        context.verbose('syncing written files')
+        context.var['writer'].close()
+
+
+def get_dn_depth(record):
+    """Return the number of RDNs above the entry of an LDIF record"""
+    dname = get_ldifv1_value(record, '\ndn:') or ''
+    return len(RGX_DN_SEP.findall(dname))
+
+
+def export_ldif(context):
+    """Write the LDIF of the backup directory to stdout"""
+    path_prefix = context.var['path_prefix']
+    fnames = sorted(f for f in os.listdir(path_prefix) if f.endswith('.ldif'))
+    # Files by the depths of their entries, a file contains several entries
+    # in single LDIF and bucket mode
+    depths = {}
+    for fname in fnames:
+        with open(''.join([path_prefix, fname]), 'r') as fin:
+            records = fin.read().split('\n\n')
+        for depth in set(get_dn_depth(r) for r in records if r.strip()):
+            depths.setdefault(depth, []).append(fname)
+    context.verbose('exporting files:', str(len(fnames)))
+    # Write parent entries before their children
+    for depth in sorted(depths):
+        for fname in depths[depth]:
+            records = read_entry(path_prefix, fname).split('\n\n')
+            for record in records:
+                if record.strip() and get_dn_depth(record) == depth:
+                    sys.stdout.write(''.join([record.strip('\n'), '\n\n']))
+
+
+def git_update_index(repo, option, fnames):
+    """Stream the filenames to `git update-index` (instead of building the
+    index entries in memory)"""
+    with tempfile.TemporaryFile() as names:
+        for fname in fnames:
+            names.write(fname.encode('utf-8'))
+            names.write(b'\0')
+        names.seek(0)
+        repo.git.update_index(option, '-z', '--stdin', istream=names)
 
 
 def git_add(context):
@@ -806,7 +1491,7 @@ def git_add(context):
         repo = context.var['repo']
         new_commit_files = context.var['new_commit_files']
         context.verbose('adding git files:', str(len(new_commit_files)))
-        repo.index.add(new_commit_files.keys())
+        git_update_index(repo, '--add', new_commit_files)
 
 
 def git_remove(context):
@@ -815,45 +1500,458 @@ def git_remove(context):
         repo = context.var['repo']
         last_commit_files = context.var['last_commit_files']
         new_commit_files = context.var['new_commit_files']
-        to_remove_files = set(last_commit_files) - set(new_commit_files.keys())
+        to_remove_files = [f for f in last_commit_files
+                           if f not in new_commit_files]
         context.verbose('removing git files:', str(len(to_remove_files)))
         if to_remove_files:
-            repo.index.remove(to_remove_files, working_tree=True)
+            git_update_index(repo, '--force-remove', to_remove_files)
+            for fname in to_remove_files:
+                try:
+                    os.remove(os.path.join(repo.working_tree_dir, fname))
+                except FileNotFoundError:
+                    pass
+
+
+def parse_entries(text):
+    """Return the entries in an LDIF text by entryUUID (or DN) as tuples of
+    DN, entryUUID and a dict with the sorted values of each attribute"""
+    entries = {}
+    for record in text.split('\n\n'):
+        record = record.strip('\n')
+        if not record:
+            continue
+        dname = get_ldifv1_value(record, '\ndn:') or ''
+        uuid = get_ldifv1_value(record, '\nentryUUID:')
+        attrs = {}
+        for attr in RGX_LDIFV1_ATTR_SEP.split(record):
+            name, _, value = attr.replace('\n ', '').partition(':')
+            # A blob reference is a value of the attribute itself
+            name = name.replace(''.join([';', BLOB_OPTION]), '')
+            attrs.setdefault(name, []).append(value)
+        for values in attrs.values():
+            values.sort()
+        entries[uuid or dname.lower()] = (dname, uuid, attrs)
+    return entries
+
+
+def diff_entries(old_text, new_text):
+    """Return the change report lines for the entries of an LDIF file"""
+    old_entries = parse_entries(old_text)
+    new_entries = parse_entries(new_text)
+    report = []
+    for key, (dname, uuid, attrs) in new_entries.items():
+        old = old_entries.get(key)
+        if old is None:
+            change, names = 'add', list(attrs)
+        else:
+            old_attrs = old[2]
+            names = [n for n in attrs if attrs[n] != old_attrs.get(n)]
+            names.extend(n for n in old_attrs if n not in attrs)
+            if not names:
+                continue
+            change = 'modify'
+        report.append({'dn': dname, 'entryUUID': uuid, 'change': change,
+                       'attributes': names})
+    for key, (dname, uuid, attrs) in old_entries.items():
+        if key not in new_entries:
+            report.append({'dn': dname, 'entryUUID': uuid,
+                           'change': 'delete', 'attributes': list(attrs)})
+    return report
+
+
+def create_change_report(context):
+    """Create the change report of the staged LDIF files, only files with
+    a changed blob id are read"""
+    if not context.param['change_report']:
+        return
+    repo = context.var['repo']
+    path_prefix = context.var['path_prefix']
+    base = 'HEAD' if repo.head.is_valid() else EMPTY_TREE
+    output = repo.git.diff_index('--cached', '-z', '--no-renames', base)
+    fields = output.split('\0')
+    report = []
+    for meta, fname in zip(fields[0::2], fields[1::2]):
+        if not fname.endswith('.ldif'):
+            continue
+        # Format: `:<old mode> <new mode> <old sha> <new sha> <status>`
+        _, _, old_sha, _, status = meta.split(' ')
+        old_text = ''
+        if status != 'A':
+            old_blob = repo.odb.stream(bytes.fromhex(old_sha))
+            old_text = old_blob.read().decode('utf-8')
+        new_text = ''
+        if status != 'D':
+            with open(''.join([path_prefix, fname]), 'r') as fin:
+                new_text = fin.read()
+        report.extend(diff_entries(old_text, new_text))
+    context.verbose('change report entries:', str(len(report)))
+    context.var['change_report'] = report
+
+
+def get_actor_env(actor):
+    """Return the environment to run git commands as actor"""
+    return {
+        'GIT_AUTHOR_NAME': actor.name,
+        'GIT_AUTHOR_EMAIL': actor.email,
+        'GIT_COMMITTER_NAME': actor.name,
+        'GIT_COMMITTER_EMAIL': actor.email,
+    }
+
+
+def truncate_change_report(context):
+    """Truncate the change report file, each commit of the run appends its
+    report"""
+    fpath = context.param['change_report']
+    if fpath and fpath != 'note':
+        open(fpath, 'w').close()
+
+
+def save_change_report(context):
+    """Attach the change report as note to the commit or append it to the
+    file with the commit id in each line (run after git_squash_history)"""
+    report = context.var['change_report']
+    if report is None or context.var['commit'] is None:
+        return
+    repo = context.var['repo']
+    # The new commit is HEAD, it may have been recreated by the squash
+    commit = repo.head.commit
+    note = context.param['change_report'] == 'note'
+    if note:
+        sha = context.var['commit'].hexsha
+        if (sha in context.var['replaced'] and
+                sha not in context.var['rewritten']):
+            # The report does not describe the changes since the new parent
+            context.verbose('change report: parent squashed, no note added')
+            return
+    else:
+        for line in report:
+            line['commit'] = commit.hexsha
+    text = ''.join([''.join([json.dumps(line, sort_keys=True), '\n'])
+                    for line in report])
+    if note:
+        fpath = os.path.join(repo.git_dir, 'ldif-git-backup-report.tmp')
+        with open(fpath, 'w') as fout:
+            fout.write(text)
+        repo.git.notes('--ref', CHANGE_REPORT_REF, 'add', '-f', '-F', fpath,
+                       commit.hexsha, env=get_actor_env(commit.committer))
+        os.remove(fpath)
+    else:
+        with open(context.param['change_report'], 'a') as fout:
+            fout.write(text)
 
 
 def git_commit(context):
     """Commit the changes"""
+    context.var['commit'] = None
     if not context.param['no_commit']:
         repo = context.var['repo']
         if not context.param['no_dirty_check'] and not repo.is_dirty():
             context.verbose('nothing to commit, working tree clean')
         else:
+            if context.param['durable']:
+                # Objects written by git add must be on disk before commit
+                sync_filesystem(context.var['path_prefix'])
             context.verbose('commiting git files')
-            repo.index.commit(context.param['commit_msg'])
+            # Commit with git itself, as GitPython reads the whole index into
+            # memory to write the tree (using the same default actors)
+            config = repo.config_reader()
+            author = git.Actor.author(config)
+            env = get_actor_env(git.Actor.committer(config))
+            env.update({'GIT_AUTHOR_NAME': author.name,
+                        'GIT_AUTHOR_EMAIL': author.email})
+            repo.git.commit('--quiet', '--allow-empty', '--cleanup=verbatim',
+                            '--no-gpg-sign', '-m', context.param['commit_msg'],
+                            env=env)
+            context.var['commit'] = repo.head.commit
+            if context.param['durable']:
+                sync_filesystem(context.var['path_prefix'])
+
+
+def get_retained_commits(commits, retention, now):
+    """Return the hexshas of the commits (newest first) to keep"""
+    all_days, daily_days = retention
+    dated = []
+    # Days and months with commits younger than all_days and daily_days
+    open_days, open_months = set(), set()
+    for commit in commits:
+        age = now - commit.committed_date
+        date = time.localtime(commit.committed_date)
+        day = time.strftime('%Y-%m-%d', date)
+        month = time.strftime('%Y-%m', date)
+        if age < all_days * 86400:
+            open_days.add(day)
+        if age < daily_days * 86400:
+            open_months.add(month)
+        dated.append((commit, age, day, month))
+    retained = set()
+    periods = set()
+    # A period is only squashed once all of its commits have aged out, so
+    # the history is rewritten at most once per day
+    for commit, age, day, month in dated:
+        if age < all_days * 86400 or day in open_days:
+            retained.add(commit.hexsha)
+            continue
+        if age < daily_days * 86400 or month in open_months:
+            period = day
+        else:
+            period = month
+        # Keep the newest commit of each period
+        if period not in periods:
+            periods.add(period)
+            retained.add(commit.hexsha)
+    return retained
+
+
+def git_bundle_commits(context, head, base):
+    """Archive the commits from base (exclusive) to head as git bundle"""
+    repo = context.var['repo']
+    dpath = pathlib.PosixPath(context.param['retention_bundle']).resolve()
+    dpath.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fname = ''.join(['ldif-git-backup-', time.strftime('%Y%m%d-%H%M%S'),
+                     '.bundle'])
+    fpath = dpath.joinpath(fname).as_posix()
+    # git bundle requires a ref for the tip of the range
+    ref = 'refs/ldif-git-backup/squashed'
+    repo.git.update_ref(ref, head.hexsha)
+    try:
+        if base:
+            repo.git.bundle('create', fpath, ref, ''.join(['^', base.hexsha]))
+        else:
+            repo.git.bundle('create', fpath, ref)
+    finally:
+        repo.git.update_ref('-d', ref)
+    context.verbose('squashed commits archived:', fpath)
+
+
+def git_copy_notes(context, rewritten, replaced):
+    """Copy the change report notes of rewritten commits and remove the
+    notes of the replaced commits"""
+    repo = context.var['repo']
+    try:
+        output = repo.git.notes('--ref', CHANGE_REPORT_REF, 'list')
+    except git.GitCommandError:
+        return
+    annotated = set(line.split(' ')[1] for line in output.splitlines())
+    env = get_actor_env(repo.head.commit.committer)
+    fpath = os.path.join(repo.git_dir, 'ldif-git-backup-rewrite.tmp')
+    pairs = [' '.join(p) for p in rewritten if p[0] in annotated]
+    if pairs:
+        with open(fpath, 'w') as fout:
+            fout.write('\n'.join(pairs))
+        with open(fpath, 'r') as fin:
+            repo.git.notes('--ref', CHANGE_REPORT_REF, 'copy', '--stdin',
+                           istream=fin, env=env)
+    removed = [sha for sha in replaced if sha in annotated]
+    if removed:
+        with open(fpath, 'w') as fout:
+            fout.write('\n'.join(removed))
+        with open(fpath, 'r') as fin:
+            repo.git.notes('--ref', CHANGE_REPORT_REF, 'remove', '--stdin',
+                           istream=fin, env=env)
+    if pairs or removed:
+        os.remove(fpath)
+
+
+def git_squash_history(context):
+    """Squash old commits according to the retention policy"""
+    context.var['squashed'] = False
+    context.var['rewritten'] = {}
+    context.var['replaced'] = set()
+    retention = context.var['retention']
+    if not retention:
+        return
+    repo = context.var['repo']
+    if not repo.head.is_valid():
+        return
+    commits = list(repo.iter_commits('HEAD', first_parent=True))
+    retained = get_retained_commits(commits, retention, time.time())
+    if len(retained) == len(commits):
+        context.verbose('retention: no commits to squash')
+        return
+    commits.reverse()
+    head = commits[-1]
+    # Commits older than the first squashed commit are kept unchanged
+    first = next(i for i, c in enumerate(commits) if c.hexsha not in retained)
+    parent = commits[first - 1] if first else None
+    context.verbose('retention: squashing',
+                    str(len(commits) - len(retained)), 'of',
+                    str(len(commits)), 'commits')
+    if context.param['retention_bundle']:
+        squashed = [c for c in commits[first:] if c.hexsha not in retained]
+        git_bundle_commits(context, squashed[-1], parent)
+    # Recreate the retained commits as snapshots (same tree, new parent)
+    rewritten = []
+    for index, commit in enumerate(commits[first:], first):
+        if commit.hexsha not in retained:
+            continue
+        author_date = ' '.join([str(commit.authored_date),
+                                altz_to_utctz_str(commit.author_tz_offset)])
+        commit_date = ' '.join([str(commit.committed_date),
+                                altz_to_utctz_str(commit.committer_tz_offset)])
+        parent = git.Commit.create_from_tree(
+            repo, commit.tree, commit.message,
+            parent_commits=[parent] if parent else [], head=False,
+            author=commit.author, committer=commit.committer,
+            author_date=author_date, commit_date=commit_date)
+        # The change report is only valid if the parent was not squashed
+        if commits[index - 1].hexsha in retained:
+            rewritten.append((commit.hexsha, parent.hexsha))
+    repo.git.update_ref('-m', 'ldif-git-backup: squash history', 'HEAD',
+                        parent.hexsha, head.hexsha)
+    replaced = [c.hexsha for c in commits[first:]]
+    git_copy_notes(context, rewritten, replaced)
+    context.var['rewritten'] = dict(rewritten)
+    context.var['replaced'] = set(replaced)
+    # Make the squashed commits unreachable, they are pruned by git gc
+    repo.git.reflog('expire', '--expire-unreachable=now', '--all')
+    context.var['squashed'] = True
+
+
+def report_replication(context):
+    """Report the state of the last replication to the mirrors"""
+    repo = context.var['repo']
+    if not context.var['mirrors'] or not repo.head.is_valid():
+        return
+    try:
+        with open(os.path.join(repo.git_dir, REPLICATION_STATUS), 'r') as fin:
+            status = json.load(fin)
+    except FileNotFoundError:
+        return
+    for mirror in context.var['mirrors']:
+        state = status.get(mirror)
+        if not state:
+            continue
+        if state['error']:
+            eprint('Warning: replication to', mirror, 'failed:',
+                   state['error'])
+        elif state['commit'] != repo.head.commit.hexsha:
+            eprint('Warning: replication to', mirror, 'is behind')
+        else:
+            context.verbose('replication to', mirror, 'lag:',
+                            '%0.3fs' % state['lag'])
+
+
+def push_mirror(repo, mirror, refspec):
+    """Push refspec to a mirror, return an error message or None"""
+    try:
+        if '://' not in mirror and ':' not in mirror:
+            # Local path, the push runs in the repository directory
+            mirror = os.path.abspath(mirror)
+            if not os.path.exists(mirror):
+                git.Repo.init(mirror, mkdir=True, bare=True)
+        repo.git.push('--thin', '--quiet', mirror, refspec)
+    except (git.GitCommandError, OSError) as err:
+        return str(getattr(err, 'stderr', '') or err).strip()
+    return None
+
+
+def replicate_mirrors(context):
+    """Push HEAD to all mirrors (run in the background process)"""
+    repo = git.Repo(context.var['path_prefix'])
+    mirrors = context.var['mirrors']
+    lock_path = os.path.join(repo.git_dir, REPLICATION_LOCK)
+    status_path = os.path.join(repo.git_dir, REPLICATION_STATUS)
+    with open(lock_path, 'w') as lock:
+        # Wait for a running replication, it may have checked HEAD before
+        # the commit this replication was started for
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=context.var['mirror_jobs'])
+        while True:
+            commit = repo.head.commit
+            refspec = ''.join(['HEAD:refs/heads/', repo.active_branch.name])
+            if context.param['retention']:
+                refspec = ''.join(['+', refspec])
+            errors = pool.map(lambda m: push_mirror(repo, m, refspec),
+                              mirrors)
+            status = {}
+            for mirror, error in zip(mirrors, errors):
+                status[mirror] = {
+                    'commit': commit.hexsha,
+                    'time': time.time(),
+                    'lag': time.time() - commit.committed_date,
+                    'error': error,
+                }
+            with open(''.join([status_path, '.tmp']), 'w') as fout:
+                json.dump(status, fout, indent=2)
+            os.replace(''.join([status_path, '.tmp']), status_path)
+            if repo.head.commit == commit:
+                break
+        pool.shutdown()
+
+
+def git_replicate(context):
+    """Start the replication to the mirrors in a background process"""
+    repo = context.var['repo']
+    if not context.var['mirrors'] or not repo.head.is_valid():
+        return
+    cmd = [sys.executable, os.path.abspath(__file__), '--replicate',
+           '-d', os.path.abspath(context.var['path_prefix']),
+           '--mirrors', ','.join(context.var['mirrors']),
+           '--mirror-jobs', str(context.var['mirror_jobs'])]
+    if context.param['retention']:
+        cmd.extend(['--retention', context.param['retention']])
+    if context.arg['config_file']:
+        cmd.extend(['-f', os.path.abspath(context.arg['config_file'])])
+    if context.arg['config']:
+        cmd.extend(['-c', context.arg['config']])
+    context.verbose('starting replication to mirrors:',
+                    str(len(context.var['mirrors'])))
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
 
 
 def git_garbage_collect(context):
     """Clean up the repo"""
     if not context.param['no_gc']:
         repo = context.var['repo']
-        context.verbose('triggering git garbage collection')
-        repo.git.gc('--auto')
-
+        if context.var['squashed']:
+            # Prune the squashed commits, also if they are already packed
+            context.verbose('pruning squashed commits')
+            repo.git.gc('--quiet', '--prune=now')
+        else:
+            context.verbose('triggering git garbage collection')
+            repo.git.gc('--auto')
 
-def main():
-    """The main function"""
-    context = Context()
 
-    create_backup_directory(context)
+def backup(context):
+    """Run a single backup"""
     initialize_git_repository(context)
+    report_replication(context)
 
     process_ldif(context)
 
     git_add(context)
     git_remove(context)
+    create_change_report(context)
     git_commit(context)
+    git_squash_history(context)
+    save_change_report(context)
+    git_replicate(context)
     git_garbage_collect(context)
 
+
+def main():
+    """The main function"""
+    context = Context()
+
+    create_backup_directory(context)
+    if context.arg['export']:
+        export_ldif(context)
+        return
+    if context.arg['replicate']:
+        replicate_mirrors(context)
+        return
+    lock_backup_directory(context)
+    truncate_change_report(context)
+
+    backup(context)
+    # Requests registered during the run are served by one more run
+    while unlock_backup_directory(context):
+        context.verbose('running pending backup')
+        backup(context)
+
     context.end_time_measurement()
 
 
@@ -0,0 +1,82 @@
+import base64
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'ldif-git-backup.py')
+
+UUID = '0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0'
+DN = 'cn=' + 'ä' * 40 + ',ou=people,dc=example,dc=com'
+PHOTO = base64.b64encode(bytes(range(256))).decode('ascii')
+
+
+def ldif_entry():
+    """Return an entry with a base64 DN, a large base64 value and a folded
+    plain value whose continuation line contains `::`"""
+    return ''.join([
+        'dn:: ', base64.b64encode(DN.encode('utf-8')).decode('ascii'), '\n',
+        'objectClass: person\n',
+        'description: folded value\n',
+        '  note::', 'x' * 80, '\n',
+        'jpegPhoto:: ', PHOTO, '\n',
+        'entryUUID: ', UUID, '\n',
+        '\n',
+    ])
+
+
+class TestBlobs(unittest.TestCase):
+
+    def run_script(self, *args):
+        return subprocess.run(
+            [sys.executable, SCRIPT, '-d', self.backup_dir] + list(args),
+            cwd=self.tmp.name, check=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp.name, 'backup')
+        self.input = os.path.join(self.tmp.name, 'input.ldif')
+        with open(self.input, 'w') as fout:
+            fout.write(ldif_entry())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_dn_and_folded_values_are_kept(self):
+        self.run_script('-l', self.input, '-G', '-R', '-A', '-C',
+                        '--blob-size', '60')
+        fpath = os.path.join(self.backup_dir, ''.join([UUID, '.ldif']))
+        with open(fpath, 'r') as fin:
+            text = fin.read()
+        lines = ldif_entry().splitlines()
+        self.assertTrue(text.startswith(lines[0] + '\n'))
+        self.assertIn('\n'.join(lines[2:4]), text)
+        self.assertIn('\njpegPhoto;x-ldif-git-backup-blob: ', text)
+        self.assertEqual(self.run_script('--export'), ldif_entry())
+
+    def test_filename_attribute_is_kept(self):
+        self.run_script('-l', self.input, '-G', '-R', '-A', '-C',
+                        '--blob-size', '60', '-a', 'dn', '-1')
+        names = [f for f in os.listdir(self.backup_dir)
+                 if f.endswith('.ldif')]
+        self.assertEqual(names, [''.join([DN, '.ldif'])])
+        with open(os.path.join(self.backup_dir, names[0]), 'r') as fin:
+            self.assertTrue(fin.read().startswith('dn:: '))
+
+    def test_blobs_are_kept_without_output(self):
+        self.run_script('-l', self.input, '-G', '--blob-size', '60')
+        self.run_script('-l', self.input, '-G', '-O', '--blob-size', '60')
+        blobs = [f for f in os.listdir(self.backup_dir) if f.endswith('.b64')]
+        self.assertEqual(len(blobs), 1)
+        tracked = subprocess.run(
+            ['git', '-C', self.backup_dir, 'ls-files', blobs[0]],
+            check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+        self.assertEqual(tracked, ''.join([blobs[0], '\n']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import base64
+import hashlib
+import importlib.util
+import io
+import os
+import re
+import tempfile
+import types
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'ldif-git-backup.py')
+
+spec = importlib.util.spec_from_file_location('ldif_git_backup', SCRIPT)
+ldif_git_backup = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ldif_git_backup)
+
+LDIF = (
+    '# extended LDIF\n'
+    '#\n'
+    'version: 1\n'
+    '\n'
+    '# people, example.com\n'
+    ' continued comment\n'
+    'dn: ou=people,dc=example,dc=com\n'
+    'objectClass: organizationalUnit\n'
+    'ou: people\n'
+    'entryUUID: 11111111-2222-3333-4444-555555555555\n'
+    'modifyTimestamp: 20200101000000Z\n'
+    '\n'
+    '\n'
+    'dn: cn=alice,ou=people,dc=example,dc=com\n'
+    'objectClass: person\n'
+    'cn: alice\n'
+    'description: a long description that is folded over several lines of\n'
+    '  the input, including a line that # looks like a comment\n'
+    '# comment inside an entry\n'
+    ' continued\n'
+    'modifyTimestamp: 20200101000000Z\n'
+    'entryUUID: 66666666-7777-8888-9999-aaaaaaaaaaaa\n'
+    '\n'
+    'dn: cn=bob,ou=people,dc=example,dc=com\n'
+    'objectClass: person\n'
+    'cn: bob\n'
+    'entryUUID: bbbbbbbb-cccc-dddd-eeee-ffffffffffff\n'
+    'description: short\n'
+)
+
+PEOPLE = (
+    'dn: ou=people,dc=example,dc=com\n'
+    'objectClass: organizationalUnit\n'
+    'ou: people\n'
+    'entryUUID: 11111111-2222-3333-4444-555555555555\n'
+)
+ALICE = (
+    'dn: cn=alice,ou=people,dc=example,dc=com\n'
+    'objectClass: person\n'
+    'cn: alice\n'
+)
+ALICE_DESCRIPTION = (
+    'description: a long description that is folded over several lines of\n'
+    '  the input, including a line that # looks like a comment\n'
+)
+BOB = (
+    'dn: cn=bob,ou=people,dc=example,dc=com\n'
+    'objectClass: person\n'
+    'cn: bob\n'
+    'entryUUID: bbbbbbbb-cccc-dddd-eeee-ffffffffffff\n'
+)
+TIMESTAMP = 'modifyTimestamp: 20200101000000Z\n'
+ALICE_UUID = 'entryUUID: 66666666-7777-8888-9999-aaaaaaaaaaaa\n'
+
+# Output of the line based LDIFv1 parser replaced by the chunk based one
+EXPECTED = {
+    '11111111-2222-3333-4444-555555555555.ldif':
+        ''.join([PEOPLE, TIMESTAMP, '\n']),
+    '66666666-7777-8888-9999-aaaaaaaaaaaa.ldif':
+        ''.join([ALICE, ALICE_DESCRIPTION, TIMESTAMP, ALICE_UUID, '\n']),
+    'bbbbbbbb-cccc-dddd-eeee-ffffffffffff.ldif':
+        ''.join([BOB, 'description: short\n', '\n']),
+}
+EXPECTED_EXCL = {
+    '11111111-2222-3333-4444-555555555555.ldif': ''.join([PEOPLE, '\n']),
+    '66666666-7777-8888-9999-aaaaaaaaaaaa.ldif':
+        ''.join([ALICE, ALICE_UUID, '\n']),
+    'bbbbbbbb-cccc-dddd-eeee-ffffffffffff.ldif': ''.join([BOB, '\n']),
+}
+
+
+class TestLdifV1(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.chunk_size = ldif_git_backup.LDIFV1_CHUNK_SIZE
+
+    def tearDown(self):
+        ldif_git_backup.LDIFV1_CHUNK_SIZE = self.chunk_size
+        self.tmp.cleanup()
+
+    def run_loop(self, data, single_ldif=False, excl_attrs=''):
+        """Run the LDIFv1 loop on data, return the written files"""
+        path_prefix = ''.join([self.tmp.name, '/'])
+        for fname in os.listdir(path_prefix):
+            os.remove(os.path.join(path_prefix, fname))
+        var = types.SimpleNamespace(
+            ldif_cmd=False, excl_attrs=bool(excl_attrs),
+            single_ldif=single_ldif, buckets=False, ldif_wrap=False,
+            path_prefix=path_prefix, fname_attr_search='entryUUID:',
+            rgx_excl=re.compile(''.join(['(', excl_attrs, '):'])),
+            no_out=False, writer=None, blob_size=0)
+        fout, files = None, {}
+        if single_ldif:
+            fout = open(''.join([path_prefix, 'db.ldif']), 'w')
+            files['db.ldif'] = 0
+        ldif_git_backup.loop_ldifv1(var, io.BytesIO(data.encode('utf-8')),
+                                    fout, files)
+        if fout:
+            fout.close()
+        written = {}
+        for fname in os.listdir(path_prefix):
+            with open(os.path.join(path_prefix, fname), 'r') as fin:
+                written[fname] = fin.read()
+        return written
+
+    def test_matches_line_based_parser(self):
+        for chunk_size in (7, 64, 4 * 1024 * 1024):
+            ldif_git_backup.LDIFV1_CHUNK_SIZE = chunk_size
+            self.assertEqual(self.run_loop(LDIF), EXPECTED)
+            self.assertEqual(
+                self.run_loop(LDIF, excl_attrs='modifyTimestamp|description'),
+                EXPECTED_EXCL)
+
+    def test_single_ldif(self):
+        ldif_git_backup.LDIFV1_CHUNK_SIZE = 64
+        written = self.run_loop(LDIF, single_ldif=True)
+        self.assertEqual(written, {'db.ldif': ''.join(
+            [EXPECTED[f] for f in sorted(EXPECTED)])})
+
+    def test_crlf(self):
+        ldif_git_backup.LDIFV1_CHUNK_SIZE = 7
+        self.assertEqual(self.run_loop(LDIF.replace('\n', '\r\n')), EXPECTED)
+
+    def test_comment_before_separator(self):
+        data = LDIF.replace(ALICE_UUID, ''.join([ALICE_UUID, '# end\n']))
+        self.assertEqual(self.run_loop(data), EXPECTED)
+
+    def test_filename_values(self):
+        url = 'file:///a/photo'
+        data = ''.join([
+            'dn: cn=a\nentryUUID:: ',
+            base64.b64encode(b'1234-abcd').decode('ascii'), '\n\n',
+            'dn: cn=b\nentryUUID:< ', url, '\n\n',
+            'dn: cn=c\nentryUUID:: ',
+            base64.b64encode(b'../evil').decode('ascii'), '\n\n',
+            'dn: cn=d\nentryUUID: 12\n 34\n\n',
+            'dn: cn=e\ncn: e\n\n',
+            'dn: cn=f\nentryUUID: f1\nentryUUID: f2\n\n',
+            'dn: cn=g\nentryUUID: g  \n\n',
+            'dn: cn=h\ncn: h\n',
+        ])
+        fnames = sorted(self.run_loop(data))
+        self.assertEqual(fnames, sorted([
+            '1234-abcd.ldif',
+            ''.join([hashlib.sha256(url.encode('utf-8')).hexdigest(),
+                     '.ldif']),
+            ''.join([b'../evil'.hex(), '.ldif']),
+            '1234.ldif',
+            'ldif-git-backup-unnamed-entry.ldif',
+            'f1.ldif',
+            'g.ldif',
+            'ldif-git-backup-unnamed-entry-1.ldif',
+        ]))
+
+
+if __name__ == '__main__':
+    unittest.main()